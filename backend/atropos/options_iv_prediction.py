@@ -1,3 +1,7 @@
+import asyncio
+import bisect
+import collections
+import functools
 import random
 import re
 from typing import Dict, List, Optional, Tuple, Union
@@ -7,6 +11,7 @@ from datasets import load_dataset
 from tqdm.asyncio import tqdm_asyncio
 
 from yahooquery import Ticker
+import numpy as np
 import pandas as pd
 
 from atroposlib.envs.base import (
@@ -25,8 +30,19 @@ You may use extremely long chains of thought to deeply consider the problem and
 
 You should enclose your thoughts and internal monologue inside <think> </think> tags, and then provide your final prediction."""  # noqa E501
 
-# User message template that contains task instructions
-user_message_template = """Your task is to analyze the following option data:
+
+# User message template that contains task instructions.
+# Written as an f-string function so the template is not re-parsed on every render.
+def render_user_message(
+    option_price,
+    underlying_stock_price,
+    strike_price,
+    time_to_expiration_years,
+    risk_free_rate,
+    option_type,
+    context,
+):
+    return f"""Your task is to analyze the following option data:
 Option Price: {option_price}
 Underlying Stock Price: {underlying_stock_price}
 Strike Price: {strike_price}
@@ -46,6 +62,127 @@ Here is the data to analyze:
 {context}"""  # context will be a summary string or can be integrated if needed
 
 
+# Stand-in user message used to split the rendered chat template around the user content
+USER_CONTENT_PLACEHOLDER = "<<user_content>>"
+
+# Everything _extract_prediction looks for, as one alternation scanned in a single pass:
+# the think tags, and the IV in "The implied volatility will be: {{answer}}%",
+# where {{answer}} is a number, possibly with decimals.
+# The metric is fixed for this environment, so the pattern is spelled out in full.
+# The alternatives share no characters that could make their matches overlap.
+PREDICTION_SCAN_RE = re.compile(
+    r"(?P<open><think>)"
+    r"|(?P<close></think>)"
+    r"|The implied volatility will be:\s*(?P<iv>[-+]?\d+(?:\.\d+)?)%",
+    re.IGNORECASE,
+)
+
+# IV accuracy scoring (differences in percentage points):
+# a prediction within IV_SCORE_THRESHOLDS[i] of the target scores IV_SCORES[i],
+# anything further off scores IV_SCORES[-1] and an exact match scores 1.0
+IV_SCORE_THRESHOLDS = [1.0, 2.5, 5.0, 10.0]
+IV_SCORES = [0.9, 0.7, 0.5, 0.3, 0.0]
+
+# Responses are dropped from training if they have fewer than MIN_UNMASKED_TOKENS unmasked
+# tokens. setup() measures how many unmasked tokens the chat template adds to an empty
+# assistant turn and derives a byte length below which a response cannot reach that, so
+# those responses skip tokenize_for_trainer.
+MIN_UNMASKED_TOKENS = 10
+
+CHAT_TEMPLATE_CACHE_SIZE = 2048  # Fully rendered prompts memoized when the template can't be split
+
+METRIC_BUFFER_SIZE = 1 << 16  # Values kept per training metric between wandb logs
+
+NS_PER_YEAR = 365.25 * 24 * 60 * 60 * 1e9
+NAT_NS = np.iinfo(np.int64).min  # int64 value pandas uses for NaT
+DEFAULT_TTE = 0.25  # Default TTE if the expiration date could not be parsed
+
+
+def parse_expiries_ns(expiration_dates):
+    """
+    Parse a whole column of expiration dates into UTC nanosecond timestamps.
+
+    Unparseable dates become NAT_NS instead of raising.
+    """
+    expiries = pd.to_datetime(
+        expiration_dates, utc=True, format="ISO8601", errors="coerce", cache=True
+    )
+    return expiries.as_unit("ns").asi8
+
+
+def time_to_expiration_years(expiries_ns, now_ns):
+    """
+    Vectorized time to expiration (in years) for an array of expiry timestamps (ns).
+    """
+    # Handle expired options if any in dataset with a very small positive number
+    tte = np.maximum((expiries_ns - now_ns) / NS_PER_YEAR, 1e-6)
+    return np.where(expiries_ns == NAT_NS, DEFAULT_TTE, tte)
+
+
+def render_batch(batch):
+    """
+    Render the user prompts and expected IV answers for a batch of dataset rows.
+
+    Used with datasets.map(batched=True), so the date arithmetic and string
+    formatting happen once per batch instead of on every get_next_item call.
+    "Now" is read on every call, so re-rendering keeps time to expiration current.
+    """
+    num_rows = len(batch["expirationDate"])
+    expiries_ns = parse_expiries_ns(batch["expirationDate"])
+    num_unparsed = int((expiries_ns == NAT_NS).sum())
+    if num_unparsed:
+        print(f"Could not parse {num_unparsed} expiration dates. Using default TTE for them.")
+    tte = time_to_expiration_years(expiries_ns, pd.Timestamp.now(tz="UTC").value)
+    # Use defaults if the optional columns are not present
+    risk_free_rates = batch.get("riskFreeRate", [0.05] * num_rows)
+    contexts = batch.get("context", ["N/A"] * num_rows)
+
+    user_contents = [
+        render_user_message(
+            option_price=batch["lastPrice"][i],
+            underlying_stock_price=batch["underlyingPrice"][i],
+            strike_price=batch["strike"][i],
+            time_to_expiration_years=f"{tte[i]:.4f}",
+            risk_free_rate=f"{risk_free_rates[i]:.4f}",
+            option_type=batch["optionType"][i],  # 'call' or 'put'
+            context=f"Further details: {contexts[i]}",
+        )
+        for i in range(num_rows)
+    ]
+    # Expected answer: implied volatility as a string percentage (e.g., "70.5")
+    expected_iv_strs = [f"{iv * 100:.1f}" for iv in batch["impliedVolatility"]]
+
+    return {"user_content": user_contents, "expected_iv_str": expected_iv_strs}
+
+
+class MetricBuffer:
+    """
+    Fixed-size float32 ring buffer for training metrics collected between wandb logs.
+
+    Once full, new values overwrite the oldest ones.
+    """
+
+    def __init__(self, size=METRIC_BUFFER_SIZE):
+        self._values = np.empty(size, dtype=np.float32)
+        self._idx = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, value):
+        self._values[self._idx] = value
+        self._idx = (self._idx + 1) % len(self._values)
+        self._count = min(self._count + 1, len(self._values))
+
+    def mean(self):
+        return float(self._values[: self._count].mean())
+
+    def clear(self):
+        self._idx = 0
+        self._count = 0
+
+
 class OptionsIVPrediction(BaseEnv):
     def __init__(
         self,
@@ -64,9 +201,11 @@ class OptionsIVPrediction(BaseEnv):
             testing: Whether in testing mode
         """
         super().__init__(config, server_configs, slurm, testing)
-        self.percent_correct_buffer = list() # Tracks format correctness
-        self.iv_accuracy_buffer = list()    # Tracks IV prediction accuracy
+        self.percent_correct_buffer = MetricBuffer() # Tracks format correctness
+        self.iv_accuracy_buffer = MetricBuffer()    # Tracks IV prediction accuracy
         self.eval_metrics = list()
+        # Most recent rollout groups for wandb, the deque drops the oldest group itself
+        self.rollouts_for_wandb = self._bounded_rollouts()
 
     @classmethod
     def config_init(self) -> Tuple[BaseEnvConfig, List[APIServerConfig]]:
@@ -114,25 +253,112 @@ class OptionsIVPrediction(BaseEnv):
         # Create train/test split (95% train, 5% test)
         split_dataset = full_dataset.train_test_split(test_size=0.05, seed=42)
 
-        # Keep the splits as is - no need to reformat
-        self.train = split_dataset["train"]
+        # Keep the raw training rows, self.train holds their rendered prompts
+        self.train_rows = split_dataset["train"]
         self.test = split_dataset["test"]
 
         # Print some dataset statistics
         print(
-            f"Loaded dataset with {len(self.train)} training examples and {len(self.test)} test examples"
+            f"Loaded dataset with {len(self.train_rows)} training examples and {len(self.test)} test examples"
+        )
+        print(f"Example item format: {self.train_rows[0]}")
+
+        # Pre-render the training prompts so get_next_item is a plain row lookup
+        self.train = self._render_train()
+
+        # Render the test set once here, so unparseable expiration dates are reported
+        # at startup. evaluate() re-renders it (one vectorized render_batch call) so that
+        # time to expiration is measured from the time of each eval.
+        rendered_test = render_batch(self.test[:])
+
+        # The system prompt never changes, so render the chat template once and
+        # build every prompt by concatenating the user content into it
+        self._prompt_prefix, self._prompt_suffix = self._split_chat_template(
+            rendered_test["user_content"][0]
+        )
+        # Otherwise memoize full renders per user content (the system prompt is constant).
+        # Wrapping the bound method keeps the cache per instance, next to its tokenizer.
+        self._apply_chat_template_cached = functools.lru_cache(
+            maxsize=CHAT_TEMPLATE_CACHE_SIZE
+        )(self._apply_chat_template)
+
+        # Unmasked tokens the chat template adds to an empty assistant turn (end-of-turn etc.)
+        empty_turn = tokenize_for_trainer(
+            self.tokenizer,
+            (
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": rendered_test["user_content"][0]},
+                {"role": "assistant", "content": ""},
+            ),
         )
-        print(f"Example item format: {self.train[0]}")
+        empty_turn_unmasked = sum(1 for i in empty_turn["masks"] if i != -100)
+        # A response of n bytes yields at most n tokens plus one standalone word-boundary
+        # token (e.g. SentencePiece's leading "▁"). This holds for byte-level BPE such as the
+        # Llama 3 tokenizer configured here, and for SentencePiece with byte fallback.
+        self._min_response_bytes = MIN_UNMASKED_TOKENS - empty_turn_unmasked - 1
 
         # Initialize iteration counter
         self.iter = 0
 
+    def _apply_chat_template(self, user_content):
+        """
+        Render the system prompt and user content with the tokenizer's chat template.
+        """
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content},
+        ]
+        return self.tokenizer.apply_chat_template(
+            messages, add_generation_prompt=True, tokenize=False
+        )
+
+    def _split_chat_template(self, sample_user_content):
+        """
+        Split the rendered chat template into the text before and after the user content.
+
+        Returns (None, None) if the template does not render the user content verbatim
+        (checked against sample_user_content), in which case prompts are rendered in full.
+        """
+        parts = self._apply_chat_template(USER_CONTENT_PLACEHOLDER).split(
+            USER_CONTENT_PLACEHOLDER
+        )
+        if len(parts) == 2:
+            prefix, suffix = parts
+            if prefix + sample_user_content + suffix == self._apply_chat_template(
+                sample_user_content
+            ):
+                return prefix, suffix
+        print("Chat template does not render user content verbatim. Rendering prompts in full.")
+        return None, None
+
+    def _render_prompt(self, user_content):
+        """
+        Build the generation prompt for a user message from the cached template parts.
+        """
+        if self._prompt_prefix is None:
+            return self._apply_chat_template_cached(user_content)
+        return self._prompt_prefix + user_content + self._prompt_suffix
+
     def save_checkpoint(self, step, data=None):
         if data is None:
             data = {}
         data["iter"] = self.iter
         super().save_checkpoint(step, data)
 
+    def _render_train(self):
+        """
+        Render the prompts and expected answers for all training rows in one batched map.
+        """
+        return self.train_rows.map(
+            render_batch,
+            batched=True,
+            batch_size=1000,
+            remove_columns=self.train_rows.column_names,
+            # render_batch reads the current time, so never reuse a cached result
+            load_from_cache_file=False,
+            keep_in_memory=True,
+        )
+
     async def get_next_item(self):
         """
         Get the next training item from the dataset.
@@ -140,67 +366,22 @@ class OptionsIVPrediction(BaseEnv):
         Returns:
             A tuple containing prompt, expected IV answer, None (for magnitude), and "implied volatility"
         """
-        next_item = self.train[self.iter % len(self.train)]
+        idx = self.iter % len(self.train)
+        if idx == 0 and self.iter > 0:
+            # Re-render at the start of each pass so time to expiration stays current
+            self.train = await asyncio.to_thread(self._render_train)
+        next_item = self.train[idx]
         self.iter += 1
 
-        # Extract data from the dataset item
-        option_price = next_item['lastPrice']
-        underlying_stock_price = next_item['underlyingPrice']
-        strike_price = next_item['strike']
-        
-        # Calculate time to expiration
-        try:
-            expiry_date_str = next_item['expirationDate']
-            # Assuming date format in CSV is 'YYYY-MM-DD HH:MM:SS' or similar pd.to_datetime can handle
-            expiry_datetime = pd.to_datetime(expiry_date_str)
-            now = pd.Timestamp.now(tz=expiry_datetime.tz) # Ensure timezone consistency
-            time_to_expiration_years = (expiry_datetime - now).total_seconds() / (365.25 * 24 * 60 * 60)
-            if time_to_expiration_years < 0: # Handle expired options if any in dataset
-                time_to_expiration_years = 1e-6 # A very small positive number
-        except Exception as e:
-            print(f"Error processing expiration date: {e}. Using default TTE.")
-            time_to_expiration_years = 0.25 # Default TTE if parsing fails
-
-        risk_free_rate = next_item.get('riskFreeRate', 0.05) # Use a default if not present
-        option_type = next_item['optionType'] # 'call' or 'put'
-        
-        # Expected answer: implied volatility as a string percentage (e.g., "70.5")
-        expected_iv_float = next_item['impliedVolatility'] 
-        expected_iv_answer_str = f"{expected_iv_float * 100:.1f}" # Format to one decimal place
-
         fundamental_metric = "implied volatility" # This is fixed for this environment
 
-        # Create context string for the prompt
-        # The user_message_template now directly includes placeholders for these values.
-        # The {context} placeholder in the template can be used for additional narrative if any.
-        # For now, we'll pass an empty string or a summary if available.
-        # The main data is now part of the template itself.
-        
-        context_details = (
-            f"Option Price: {option_price}, "
-            f"Underlying Stock Price: {underlying_stock_price}, "
-            f"Strike Price: {strike_price}, "
-            f"Time to Expiration (Years): {time_to_expiration_years:.4f}, "
-            f"Risk-Free Rate: {risk_free_rate:.4f}, "
-            f"Option Type: {option_type}"
-        )
-
+        # Messages are stored as plain (role, content) tuples
         prompt = []
-        prompt.append(frozenset({"role": "system", "content": system_prompt}.items()))
-
-        user_content = user_message_template.format(
-            option_price=option_price,
-            underlying_stock_price=underlying_stock_price,
-            strike_price=strike_price,
-            time_to_expiration_years=f"{time_to_expiration_years:.4f}",
-            risk_free_rate=f"{risk_free_rate:.4f}",
-            option_type=option_type,
-            context=f"Further details: {next_item.get('context', 'N/A')}" # If there's a generic context field
-        )
-        prompt.append(frozenset({"role": "user", "content": user_content}.items()))
+        prompt.append(("system", system_prompt))
+        prompt.append(("user", next_item["user_content"]))
 
         # Return (prompt_tuple, expected_iv_str, None for magnitude, "implied volatility")
-        return (tuple(prompt), expected_iv_answer_str, None, fundamental_metric)
+        return (tuple(prompt), next_item["expected_iv_str"], None, fundamental_metric)
 
     async def collect_trajectories(self, item) -> Tuple[ScoredDataGroup, List]:
         """
@@ -212,15 +393,9 @@ class OptionsIVPrediction(BaseEnv):
         Returns:
             Tuple of lists containing scored data groups and backlog
         """
-        # Extract messages from the item
-        messages = []
-        for role_dict in item[0]:
-            messages.append(dict(role_dict))
-
-        # Apply chat template to convert messages to a single string
-        prompt = self.tokenizer.apply_chat_template(
-            messages, add_generation_prompt=True, tokenize=False
-        )
+        # Convert the user message to a single prompt string
+        _, user_content = item[0][-1]
+        prompt = self._render_prompt(user_content)
 
         # Get completions from the model
         completions = await self.server.completion(
@@ -234,9 +409,9 @@ class OptionsIVPrediction(BaseEnv):
 
         for _, completion_choice in enumerate(completions.choices):
             # Create a copy of the prompt messages
-            trajectory_messages = []
-            for role_dict in item[0]:
-                trajectory_messages.append(dict(role_dict))
+            trajectory_messages = [
+                {"role": role, "content": content} for role, content in item[0]
+            ]
 
             # Add the model's response
             trajectory_messages.append(
@@ -270,43 +445,30 @@ class OptionsIVPrediction(BaseEnv):
         Returns:
             Tuple of (iv_prediction_str, None) or (None, None) if extraction fails
         """
-        # Check for thinking section
-        think_tags = re.findall(r"<think>", text, re.IGNORECASE)
-        think_close_tags = re.findall(r"</think>", text, re.IGNORECASE)
-
-        # Verify thinking format - must have exactly one opening and one closing tag
-        if len(think_tags) != 1 or len(think_close_tags) != 1:
+        # Walk the think tags and IV answers in order; the answer section is everything
+        # after </think>, and only IV answers found there count
+        num_open_tags = 0
+        num_close_tags = 0
+        iv_matches = []
+        for match in PREDICTION_SCAN_RE.finditer(text):
+            if match.lastgroup == "open":
+                num_open_tags += 1
+            elif match.lastgroup == "close":
+                num_close_tags += 1
+            elif num_close_tags:
+                iv_matches.append(match.group("iv"))
+
+            # Verify thinking format - exactly one opening tag, followed by one closing tag
+            if num_close_tags > 1 or num_open_tags > 1 or num_close_tags > num_open_tags:
+                return None, None
+
+        if num_open_tags != 1 or num_close_tags != 1:
             return None, None
 
-        # Split on </think> to separate thinking from answer
-        parts = re.split(r"</think>", text, flags=re.IGNORECASE, maxsplit=1)
-        if len(parts) != 2:
-            return None, None
-
-        thinking_section, answer_section = parts
-
-        # Validate thinking section contains opening tag
-        if "<think>" not in thinking_section.lower():
-            return None, None
-
-        # Escape fundamental_metric for regex (e.g., "implied volatility")
-        escaped_metric = re.escape(fundamental_metric)
-
-        # Regex to capture IV: "The implied volatility will be: {{answer}}%"
-        # {{answer}} is a number, possibly with decimals.
-        pattern = f"The {escaped_metric} will be:\\s*([-+]?\\d+(?:\\.\\d+)?)%"
-
-        all_matches = re.findall(pattern, answer_section, re.IGNORECASE)
-
-        if len(all_matches) != 1:
+        if len(iv_matches) != 1:
             return None, None # No match or multiple matches
 
-        # Extract single match
-        matches = re.search(pattern, answer_section, re.IGNORECASE)
-        if not matches or len(matches.groups()) != 1:
-            return None, None
-
-        iv_prediction_str = matches.group(1)
+        iv_prediction_str = iv_matches[0]
 
         return iv_prediction_str, None # Return IV string and None for magnitude part
 
@@ -328,30 +490,25 @@ class OptionsIVPrediction(BaseEnv):
 
             diff = abs(pred_iv - exp_iv) # Difference in percentage points
 
-            # Score based on closeness (adjust thresholds as needed for IV)
-            # Perfect match = 1.0
-            # Within 1 percentage point = 0.9
-            # Within 2.5 percentage points = 0.7
-            # Within 5 percentage points = 0.5
-            # Within 10 percentage points = 0.3
-            # More than 10 percentage points off = 0.0
+            # Perfect match = 1.0, otherwise look up the first threshold diff is within
             if diff == 0:
                 return 1.0
-            elif diff <= 1.0: # 1% absolute IV difference
-                return 0.9
-            elif diff <= 2.5: # 2.5% absolute IV difference
-                return 0.7
-            elif diff <= 5.0: # 5% absolute IV difference
-                return 0.5
-            elif diff <= 10.0: # 10% absolute IV difference
-                return 0.3
-            else:
+            if np.isnan(diff): # e.g. missing IV in the dataset
                 return 0.0
+            return IV_SCORES[bisect.bisect_left(IV_SCORE_THRESHOLDS, diff)]
 
         except ValueError:
             # If conversion fails, return 0
             return 0.0
 
+    def _record_score_metrics(self, format_correct_and_extracted, iv_accuracy_score):
+        """
+        Record the format and IV accuracy metrics of one scored response.
+        """
+        self.percent_correct_buffer.append(format_correct_and_extracted)
+        if format_correct_and_extracted == 1.0: # Only record accuracy if format was OK
+            self.iv_accuracy_buffer.append(iv_accuracy_score)
+
     async def score(
         self, rollout_group_data
     ) -> Union[Optional[ScoredDataGroup], List[Optional[ScoredDataGroup]]]:
@@ -377,10 +534,16 @@ class OptionsIVPrediction(BaseEnv):
         # Shuffle to avoid bias in selection
         random.shuffle(rollout_group_data)
 
-        for item in rollout_group_data:
-            # Extract the model's response
-            model_response = item[0][-1]["content"]
+        # Token lengths of all responses from a single batched tokenizer call
+        model_responses = [item[0][-1]["content"] for item in rollout_group_data]
+        response_lengths = [
+            len(ids) for ids in self.tokenizer(model_responses)["input_ids"]
+        ]
 
+        # First pass: score every response (cheap, no tokenization for the trainer)
+        rewards = []
+        item_metrics = []  # (format_correct_and_extracted, iv_accuracy_score) per response
+        for model_response, response_tokens in zip(model_responses, response_lengths):
             # Extract the prediction (IV string) from the model's response
             predicted_iv_str, _ = self._extract_prediction( # Second element is None
                 model_response, fundamental_metric
@@ -402,13 +565,28 @@ class OptionsIVPrediction(BaseEnv):
                 final_score = 1.0 + iv_accuracy_score 
 
             # Apply length penalty for responses that are too long
-            response_tokens = len(self.tokenizer.encode(model_response))
             if response_tokens > self.config.max_token_length * 0.95:
                 # Penalize responses that are close to the max token limit
                 final_score -= 0.5 * (response_tokens / self.config.max_token_length)
 
             # For binary reward signal, any positive score gets +1, otherwise -1
-            binary_reward = 1.0 if final_score > 0 else -1.0
+            rewards.append(1.0 if final_score > 0 else -1.0)
+            item_metrics.append((format_correct_and_extracted, iv_accuracy_score))
+
+        # Return None if all scores are the same (no learning signal),
+        # before paying for tokenize_for_trainer on every item
+        if len(set(rewards)) == 1:
+            for format_correct_and_extracted, iv_accuracy_score in item_metrics:
+                self._record_score_metrics(format_correct_and_extracted, iv_accuracy_score)
+            return None
+
+        # Second pass: tokenize only groups that carry a learning signal
+        for item, model_response, binary_reward, metrics in zip(
+            rollout_group_data, model_responses, rewards, item_metrics
+        ):
+            # Skip responses too short to ever pass the unmasked token check below
+            if len(model_response.encode("utf-8")) < self._min_response_bytes:
+                continue
 
             # Tokenize the conversation for learning
             out_dict = tokenize_for_trainer(self.tokenizer, item[0])
@@ -416,79 +594,39 @@ class OptionsIVPrediction(BaseEnv):
             masks = out_dict["masks"]
 
             # Remove examples with insufficient context
-            if len([1 for i in masks if i != -100]) < 10:
+            if sum(1 for i in masks if i != -100) < MIN_UNMASKED_TOKENS:
                 continue
 
             scores["tokens"].append(tokens)
             scores["masks"].append(masks)
             scores["scores"].append(binary_reward)
 
-            # For tracking metrics
-            self.percent_correct_buffer.append(format_correct_and_extracted)
-            if format_correct_and_extracted == 1.0: # Only record accuracy if format was OK
-                self.iv_accuracy_buffer.append(iv_accuracy_score)
+            # For tracking metrics, only for responses kept for training
+            self._record_score_metrics(*metrics)
 
             # Break once we have enough examples
             if len(scores["tokens"]) >= self.config.group_size:
                 break
 
-        # Return None if all scores are the same (no learning signal)
+        # The filter above can still leave only one kind of score
         if all(scores["scores"][0] == score for score in scores["scores"]):
             return None
 
         return scores
 
-    async def rollout_and_score_eval(self, test_item):
+    async def rollout_and_score_eval(self, prompt, expected_iv_str):
         """
         Generate and score model responses for a single test item.
 
         Args:
-            test_item: Test item from dataset (already processed by get_next_item structure)
+            prompt: Rendered generation prompt for the test item
+            expected_iv_str: Expected IV string for the test item (e.g., "70.5")
 
         Returns:
             Dictionary with format_correct_score and iv_accuracy_score
         """
-        # Reconstruct prompt and expected values from test_item if it's raw from dataset
-        # Or assume test_item is already in the (prompt_tuple, expected_iv_str, None, "implied volatility") format
-        # For simplicity, let's assume test_item is raw and we re-process it like in get_next_item
-        
-        option_price = test_item['lastPrice']
-        underlying_stock_price = test_item['underlyingPrice']
-        strike_price = test_item['strike']
-        try:
-            expiry_date_str = test_item['expirationDate']
-            expiry_datetime = pd.to_datetime(expiry_date_str)
-            now = pd.Timestamp.now(tz=expiry_datetime.tz)
-            time_to_expiration_years = (expiry_datetime - now).total_seconds() / (365.25 * 24 * 60 * 60)
-            if time_to_expiration_years < 0: time_to_expiration_years = 1e-6
-        except Exception: time_to_expiration_years = 0.25
-        risk_free_rate = test_item.get('riskFreeRate', 0.05)
-        option_type = test_item['optionType']
-        expected_iv_float = test_item['impliedVolatility']
-        expected_iv_str = f"{expected_iv_float * 100:.1f}"
         fundamental_metric = "implied volatility"
 
-        user_content = user_message_template.format(
-            option_price=option_price,
-            underlying_stock_price=underlying_stock_price,
-            strike_price=strike_price,
-            time_to_expiration_years=f"{time_to_expiration_years:.4f}",
-            risk_free_rate=f"{risk_free_rate:.4f}",
-            option_type=option_type,
-            context=f"Further details: {test_item.get('context', 'N/A')}"
-        )
-
-        # Create messages for model
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_content},
-        ]
-
-        # Apply chat template to convert messages to a single string
-        prompt = self.tokenizer.apply_chat_template(
-            messages, add_generation_prompt=True, tokenize=False
-        )
-
         # Get model completion
         completion = await self.server.completion(
             prompt=prompt,
@@ -529,9 +667,21 @@ class OptionsIVPrediction(BaseEnv):
         """
         Evaluate the model on test data.
         """
+        def render_eval_prompts():
+            rendered_test = render_batch(self.test[:])
+            prompts = [
+                self._render_prompt(user_content)
+                for user_content in rendered_test["user_content"]
+            ]
+            return prompts, rendered_test["expected_iv_str"]
+
+        # Render every eval prompt up front on a worker thread, off the event loop,
+        # so the coroutines below only wait on the inference server
+        prompts, expected_iv_strs = await asyncio.to_thread(render_eval_prompts)
+
         eval_tasks = []
-        for test_item in self.test:
-            eval_tasks.append(self.rollout_and_score_eval(test_item))
+        for prompt, expected_iv_str in zip(prompts, expected_iv_strs):
+            eval_tasks.append(self.rollout_and_score_eval(prompt, expected_iv_str))
 
         # Run evaluation
         all_scores = await tqdm_asyncio.gather(*eval_tasks)
@@ -565,22 +715,14 @@ class OptionsIVPrediction(BaseEnv):
             wandb_metrics = {}
 
         # Calculate and log training format correctness
-        try:
-            avg_format_correctness = sum(self.percent_correct_buffer) / len(
-                self.percent_correct_buffer
-            )
+        if len(self.percent_correct_buffer) > 0:
+            avg_format_correctness = self.percent_correct_buffer.mean()
             wandb_metrics["train/avg_format_correctness"] = avg_format_correctness
-        except ZeroDivisionError:
-            pass
 
         # Calculate and log training IV accuracy
-        try:
-            avg_iv_accuracy = sum(self.iv_accuracy_buffer) / len(
-                self.iv_accuracy_buffer
-            )
+        if len(self.iv_accuracy_buffer) > 0:
+            avg_iv_accuracy = self.iv_accuracy_buffer.mean()
             wandb_metrics["train/avg_iv_accuracy"] = avg_iv_accuracy
-        except ZeroDivisionError:
-            pass
 
         # Calculate combined training score
         try:
@@ -597,8 +739,8 @@ class OptionsIVPrediction(BaseEnv):
             pass
 
         # Clear the buffers after logging
-        self.percent_correct_buffer = list()
-        self.iv_accuracy_buffer = list()
+        self.percent_correct_buffer.clear()
+        self.iv_accuracy_buffer.clear()
 
         # Log evaluation metrics
         for item in self.eval_metrics:
@@ -607,15 +749,19 @@ class OptionsIVPrediction(BaseEnv):
 
         await super().wandb_log(wandb_metrics)
 
+    def _bounded_rollouts(self, groups=()):
+        """
+        Wrap rollout groups in a deque holding at most num_rollouts_to_keep groups.
+        """
+        return collections.deque(
+            groups, maxlen=getattr(self.config, "num_rollouts_to_keep", 10)
+        )
+
     async def add_rollouts_for_wandb(
         self,
         scored_data: Union[ScoredDataGroup, List[ScoredDataGroup]],
         item: Item = None, # item is (prompt_tuple, expected_iv_str, None, "implied volatility")
     ):
-        # Initialize rollouts_for_wandb if not exists
-        if not hasattr(self, "rollouts_for_wandb"):
-            self.rollouts_for_wandb = []
-
         # Get number of examples to keep
         num_keep = getattr(self.config, "num_rollouts_per_group_for_logging", -1)
 
@@ -625,11 +771,17 @@ class OptionsIVPrediction(BaseEnv):
         # Get metric type from item
         metric_type = item[3] # Should be "implied volatility"
 
-        # Add examples to rollouts
+        # BaseEnv.wandb_log resets rollouts_for_wandb to a plain list after each log,
+        # so restore the bounded deque before appending
+        if not isinstance(self.rollouts_for_wandb, collections.deque):
+            self.rollouts_for_wandb = self._bounded_rollouts(self.rollouts_for_wandb)
+
+        # Add examples to rollouts. Token IDs are kept so only groups that are actually
+        # logged get decoded, in create_rollout_table.
         self.rollouts_for_wandb.append(
             [
                 (
-                    self.tokenizer.decode(scored_data["tokens"][i]),
+                    scored_data["tokens"][i],
                     scored_data["scores"][i],
                     item[1],  # expected_iv_str
                     None,     # placeholder for expected_magnitude, which is not used here
@@ -639,13 +791,15 @@ class OptionsIVPrediction(BaseEnv):
             ]
         )
 
-        # Keep buffer size limited
-        max_rollouts = getattr(self.config, "num_rollouts_to_keep", 10)
-        if len(self.rollouts_for_wandb) > max_rollouts:
-            self.rollouts_for_wandb.pop(0)
-
     async def create_rollout_table(self, wandb_metrics):
-        if hasattr(self, "rollouts_for_wandb") and len(self.rollouts_for_wandb) > 0:
+        if len(self.rollouts_for_wandb) > 0:
+            # Build all rows first and hand them to the Table in one go instead of add_data per row
+            item_tuples = [item_tuple for group in self.rollouts_for_wandb for item_tuple in group]
+            texts = self.tokenizer.batch_decode([item_tuple[0] for item_tuple in item_tuples])
+            rows = [
+                [text, item_tuple[1], item_tuple[2], item_tuple[3], item_tuple[4]]
+                for text, item_tuple in zip(texts, item_tuples)
+            ]
             table = wandb.Table(
                 columns=[
                     "text",
@@ -653,17 +807,14 @@ class OptionsIVPrediction(BaseEnv):
                     "expected_iv", # Renamed from expected_direction
                     "expected_magnitude_placeholder", # Renamed, clarify it's a placeholder
                     "metric_type", # Renamed from fundamental_metric for consistency
-                ]
+                ],
+                data=rows,
             )
 
-            for group in self.rollouts_for_wandb:
-                for item_tuple in group: # Renamed item to item_tuple to avoid conflict
-                    table.add_data(item_tuple[0], item_tuple[1], item_tuple[2], item_tuple[3], item_tuple[4])
-
             wandb_metrics["train/rollouts"] = table
 
         # Clear rollouts after logging
-        self.rollouts_for_wandb = []
+        self.rollouts_for_wandb.clear()
 
         return wandb_metrics
 
@@ -23,20 +23,35 @@ optimizer = optim.Adam(policy.parameters(), lr=0.1)
 def get_reward(action):
     return 1.0 if action ==1 else 0.0
 
-for episode in range(100):
-    action_probs = policy()
-
-    action_dist = torch.distributions.Categorical(action_probs)
-    action  = action_dist.sample()
-
-    reward = get_reward(action.item())
-
-    log_prob = torch.log(action_probs[action])
-    loss = -log_prob * reward
-
-    optimizer.zero_grad()
-    loss.backward()
-    optimizer.step()
-
-    if episode % 10 == 0 or episode ==99:
-        print(f"Episode {episode:3d}: Action={action.item()}, reward={reward}, Probs={action_probs.detach().numpy()}")
\ No newline at end of file
+num_episodes = 100
+# Draw every episode's sampling noise up front: action 1 is taken when u < P(action 1)
+uniforms = torch.rand(num_episodes)
+
+# Logged episodes write (action, reward, probs) into a preallocated buffer,
+# which is copied to the host and printed once after training
+log_episodes = list(range(0, num_episodes, 10)) + [num_episodes - 1]
+log_history = torch.empty(len(log_episodes), 4)
+
+# REINFORCE without autograd: the gradient of -log(pi(a)) * reward w.r.t. the logits
+# is (softmax(logits) - onehot(a)) * reward, so it is written into .grad directly
+with torch.no_grad():
+    for episode in range(num_episodes):
+        action_probs = policy()
+
+        action = int(uniforms[episode] < action_probs[1])
+
+        reward = get_reward(action)
+
+        grad = action_probs * reward
+        grad[action] -= reward
+        policy.logits.grad = grad
+        optimizer.step()
+
+        if episode % 10 == 0 or episode == num_episodes - 1:
+            row = log_history[log_episodes.index(episode)]
+            row[0] = action
+            row[1] = reward
+            row[2:] = action_probs
+
+for episode, row in zip(log_episodes, log_history.cpu().numpy()):
+    print(f"Episode {episode:3d}: Action={int(row[0])}, reward={row[1]}, Probs={row[2:]}")
\ No newline at end of file